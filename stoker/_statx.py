@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+#
+#     _statx.py: access to the Linux statx system call
+#     Copyright (C) University of Manchester 2018-2021 Peter Briggs
+#
+
+"""
+Access to the Linux statx system call via ctypes
+
+Provides an 'lstat' function which fetches only the basic
+metadata used by stoker (type, mode, owner, size and
+modification time) and which passes AT_STATX_DONT_SYNC, so
+that on network file systems cached values are used rather
+than forcing a synchronisation with the server.
+
+'HAVE_STATX' is set at import time to indicate whether
+statx is usable on the current system; if it isn't then
+'lstat' falls back to os.lstat.
+"""
+
+import os
+import sys
+import platform
+import collections
+import ctypes
+
+# Constants from <fcntl.h> and <linux/stat.h>
+AT_FDCWD = -100
+AT_SYMLINK_NOFOLLOW = 0x100
+AT_STATX_DONT_SYNC = 0x4000
+STATX_TYPE = 0x1
+STATX_MODE = 0x2
+STATX_UID = 0x8
+STATX_GID = 0x10
+STATX_MTIME = 0x40
+STATX_SIZE = 0x200
+
+# Mask of fields to request
+STATX_MASK = (STATX_TYPE|STATX_MODE|STATX_UID|STATX_GID|
+              STATX_SIZE|STATX_MTIME)
+
+# System call numbers (used if libc doesn't provide statx)
+SYS_STATX = { 'x86_64': 332,
+              'aarch64': 291, }
+
+# Stat-like result
+StatxResult = collections.namedtuple(
+    "StatxResult",
+    ['st_mode',
+     'st_uid',
+     'st_gid',
+     'st_size',
+     'st_mtime',
+     'st_mtime_ns',
+     'st_dev',],)
+
+class _StatxTimestamp(ctypes.Structure):
+    _fields_ = [('tv_sec',ctypes.c_int64),
+                ('tv_nsec',ctypes.c_uint32),
+                ('_reserved',ctypes.c_int32),]
+
+class _Statx(ctypes.Structure):
+    _fields_ = [('stx_mask',ctypes.c_uint32),
+                ('stx_blksize',ctypes.c_uint32),
+                ('stx_attributes',ctypes.c_uint64),
+                ('stx_nlink',ctypes.c_uint32),
+                ('stx_uid',ctypes.c_uint32),
+                ('stx_gid',ctypes.c_uint32),
+                ('stx_mode',ctypes.c_uint16),
+                ('_spare0',ctypes.c_uint16),
+                ('stx_ino',ctypes.c_uint64),
+                ('stx_size',ctypes.c_uint64),
+                ('stx_blocks',ctypes.c_uint64),
+                ('stx_attributes_mask',ctypes.c_uint64),
+                ('stx_atime',_StatxTimestamp),
+                ('stx_btime',_StatxTimestamp),
+                ('stx_ctime',_StatxTimestamp),
+                ('stx_mtime',_StatxTimestamp),
+                ('stx_rdev_major',ctypes.c_uint32),
+                ('stx_rdev_minor',ctypes.c_uint32),
+                ('stx_dev_major',ctypes.c_uint32),
+                ('stx_dev_minor',ctypes.c_uint32),
+                ('_spare2',ctypes.c_uint64*14),]
+
+def _load_statx():
+    """
+    Return a function which invokes statx, or None
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(None,use_errno=True)
+    except OSError:
+        return None
+    try:
+        # Use the glibc wrapper (glibc 2.28+)
+        func = libc.statx
+        func.argtypes = (ctypes.c_int,
+                         ctypes.c_char_p,
+                         ctypes.c_int,
+                         ctypes.c_uint,
+                         ctypes.POINTER(_Statx))
+        func.restype = ctypes.c_int
+        return func
+    except AttributeError:
+        pass
+    # Invoke the system call directly
+    try:
+        sys_statx = SYS_STATX[platform.machine()]
+        syscall = libc.syscall
+    except (KeyError,AttributeError):
+        return None
+    syscall.restype = ctypes.c_long
+    def func(dirfd,path,flags,mask,buf):
+        return syscall(ctypes.c_long(sys_statx),
+                       ctypes.c_int(dirfd),
+                       ctypes.c_char_p(path),
+                       ctypes.c_int(flags),
+                       ctypes.c_uint(mask),
+                       buf)
+    return func
+
+_statx = _load_statx()
+
+def _statx_lstat(path):
+    """
+    Fetch metadata for 'path' using statx
+    """
+    buf = _Statx()
+    if _statx(AT_FDCWD,
+              os.fsencode(path),
+              AT_SYMLINK_NOFOLLOW|AT_STATX_DONT_SYNC,
+              STATX_MASK,
+              ctypes.byref(buf)) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err,os.strerror(err),path)
+    if (buf.stx_mask & STATX_MASK) != STATX_MASK:
+        # Not all the requested fields were returned
+        return os.lstat(path)
+    mtime = buf.stx_mtime
+    return StatxResult(
+        st_mode=buf.stx_mode,
+        st_uid=buf.stx_uid,
+        st_gid=buf.stx_gid,
+        st_size=buf.stx_size,
+        st_mtime=float(mtime.tv_sec) + mtime.tv_nsec*1e-9,
+        st_mtime_ns=mtime.tv_sec*1000000000 + mtime.tv_nsec,
+        st_dev=os.makedev(buf.stx_dev_major,buf.stx_dev_minor))
+
+def _have_statx():
+    """
+    Check whether statx can actually be used
+    """
+    if _statx is None:
+        return False
+    try:
+        _statx_lstat(os.sep)
+        return True
+    except OSError:
+        # E.g. ENOSYS on old kernels, or EPERM if blocked
+        # by a seccomp filter
+        return False
+
+HAVE_STATX = _have_statx()
+
+def lstat(path):
+    """
+    Return metadata for 'path' without following symlinks
+
+    Uses statx if available, otherwise os.lstat (which is
+    also used if statx doesn't return all the requested
+    fields). In all cases OSError is raised if the path
+    can't be accessed.
+    """
+    if HAVE_STATX:
+        return _statx_lstat(path)
+    return os.lstat(path)
@@ -3,34 +3,88 @@
 #     cli.py: command line interfaces
 #     Copyright (C) University of Manchester 2018-2021 Peter Briggs
 #
+import os
 import argparse
-import getpass
+import hashlib
 from . import commands
 from . import index
 
+# Multipliers for size units
+SIZE_UNITS = { 'K': 1024,
+               'M': 1024*1024,
+               'G': 1024*1024*1024, }
+
+def _size_arg(s):
+    """
+    Convert a size argument (e.g. '10', '2K', '1G') to bytes
+    """
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    try:
+        return int(s[:-1])*SIZE_UNITS[s[-1]]
+    except (ValueError,KeyError,IndexError):
+        raise argparse.ArgumentTypeError("%s: invalid size" % s)
+
+def _hash_arg(s):
+    """
+    Check a hash algorithm argument (e.g. 'md5', 'blake2b')
+
+    The algorithm must be supported by hashlib and produce
+    a fixed length digest (so e.g. 'shake_128' is rejected).
+    """
+    try:
+        digest_size = hashlib.new(s).digest_size
+    except (ValueError,TypeError):
+        digest_size = 0
+    if not digest_size:
+        raise argparse.ArgumentTypeError("%s: unsupported hash "
+                                         "algorithm" % s)
+    return s
+
 def main(args=None):
     
     # Set up top-level command line parser
     parser = argparse.ArgumentParser(
         description="Examine and curate NGS data")
 
+    # Options common to all subcommands
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument("-j","--jobs",type=int,
+                               dest='workers',default=None,
+                               help="number of threads to use when "
+                               "scanning directories (default: "
+                               "value of STOKER_WALK_THREADS, or "
+                               "%d if not set)" % index.WALK_THREADS)
+
     # Add subcommand parsers
     subparsers = parser.add_subparsers(dest='command',
                                        help="Available commands")
 
     # 'compare' command
     cmp_parser = subparsers.add_parser("compare",
+                                       parents=[common_parser],
                                        help="compare two directories")
     cmp_parser.add_argument("source",default=None)
     cmp_parser.add_argument("target",default=None)
+    cmp_parser.add_argument("--hash",dest='hash_algo',
+                            type=_hash_arg,default=None,
+                            help="checksum algorithm used to check "
+                            "the contents of files (any algorithm "
+                            "supported by Python's hashlib, e.g. "
+                            "'sha1' or 'blake2b'; default: value of "
+                            "STOKER_HASH, or 'md5' if not set)")
 
     # 'accessibility' command
     access_parser = subparsers.add_parser("check_access",
+                                       parents=[common_parser],
                                        help="check accessibility")
     access_parser.add_argument("dir",default=None)
 
     # 'find' command
     find_parser = subparsers.add_parser("find",
+                                        parents=[common_parser],
                                         help="search for files")
     find_parser.add_argument("dir",default=None,
                              help="directory to search")
@@ -42,6 +96,7 @@ def main(args=None):
                              "listed extensions")
     find_parser.add_argument("-s","--size",metavar='MINSIZE',
                              dest='min_size',default=None,
+                             type=_size_arg,
                              help="only include objects greater "
                              "than or equal to MINSIZE; MINSIZE "
                              "must be either: a number of bytes, "
@@ -76,48 +131,54 @@ def main(args=None):
     find_parser.add_argument("-f","--full_paths",action='store_true',
                              help="report full paths to matching "
                              "objects")
+    find_parser.add_argument("--snapshot",action='store_true',
+                             help="use (and update) a saved snapshot "
+                             "of the directory to speed up indexing; "
+                             "the contents of subdirectories which "
+                             "haven't been modified since the "
+                             "snapshot was saved are taken from the "
+                             "snapshot without being checked again")
     
     # Process the command line
     args = parser.parse_args()
+    if args.command == "compare" and args.hash_algo is None:
+        # Check the default before any indexing is done
+        try:
+            args.hash_algo = _hash_arg(os.environ.get("STOKER_HASH",
+                                                      "md5"))
+        except argparse.ArgumentTypeError as ex:
+            cmp_parser.error("STOKER_HASH: %s" % ex)
     print("Command: %s" % args.command)
 
     # Compare
     if args.command == "compare":
-        commands.compare(args.source,args.target)
+        commands.compare(args.source,args.target,
+                         workers=args.workers,
+                         hash_algo=args.hash_algo)
 
     # Accessibility
     if args.command == "check_access":
-        commands.check_accessibility(args.dir)
+        commands.check_accessibility(args.dir,
+                                     workers=args.workers)
 
     # Find
     if args.command == "find":
         if args.mine:
+            # Only needed here so imported on demand
+            import getpass
             users = getpass.getuser()
         else:
             users = args.users
-        min_size = args.min_size
-        if min_size:
-            try:
-                min_size = int(min_size)
-            except ValueError:
-                min_size,units = (int(min_size[:-1]),min_size[-1])
-                if units == 'G':
-                    min_size = min_size*1024*1024*1024
-                elif units == 'M':
-                    min_size = min_size*1024*1024
-                elif units == 'K':
-                    min_size = min_size*1024
-                else:
-                    raise Exception("%s: invalid size option" %
-                                    args.min_size)
         commands.find(args.dir,
                       exts=args.extensions,
                       users=users,
-                      size=min_size,
+                      size=args.min_size,
                       only_hidden=args.only_hidden,
                       nocompressed=args.nocompressed,
                       nosymlinks=args.nosymlinks,
                       long_listing=args.long_listing,
-                      full_paths=args.full_paths)
+                      full_paths=args.full_paths,
+                      use_snapshot=args.snapshot,
+                      workers=args.workers)
 
 
@@ -5,23 +5,73 @@
 #
 
 import os
+import sys
+import collections
 from . import index
 
+# Size of output buffer used by _BufferedPrinter
+OUTPUT_BUFFER_SIZE = 64*1024
+
+class _BufferedPrinter(object):
+    """
+    Context manager for writing lines of output in batches
+
+    Lines passed to the 'print' method are accumulated and
+    written to the output stream (stdout by default) in a
+    single call once they exceed OUTPUT_BUFFER_SIZE
+    characters, and when the context is exited.
+    """
+    def __init__(self,fp=None,bufsize=OUTPUT_BUFFER_SIZE):
+        """
+        """
+        if fp is None:
+            fp = sys.stdout
+        self._fp = fp
+        self._bufsize = bufsize
+        self._lines = []
+        self._size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.flush()
+
+    def print(self,line):
+        """
+        Add a line of output (without a trailing newline)
+        """
+        self._lines.append(line)
+        self._size += len(line) + 1
+        if self._size > self._bufsize:
+            self.flush()
+
+    def flush(self):
+        """
+        Write any buffered lines to the output stream
+        """
+        if self._lines:
+            self._lines.append('')
+            self._fp.write('\n'.join(self._lines))
+            self._lines = []
+            self._size = 0
+
 def _print_list(l):
     """
     """
-    for i in l:
-        print("\t%s" % i)
+    if l:
+        sys.stdout.write("\t" + "\n\t".join(l) + "\n")
 
 def _pretty_print_size(s):
     """
     """
     units = "bKMG"
-    i = 0
-    while s > 1024 and units[i] != 'G':
-        s = float(s)/1024.0
-        i += 1
-    return "%.1f%s" % (s,units[i])
+    if s <= 1024:
+        return f"{s:.1f}{units[0]}"
+    # Largest unit which the size exceeds (up to 'G'),
+    # from the number of bits needed to hold the size
+    i = min(((s-1).bit_length()-1)//10,len(units)-1)
+    return f"{s/(1 << (10*i)):.1f}{units[i]}"
 
 def _summarise_find(names,indx):
     """
@@ -29,82 +79,79 @@ def _summarise_find(names,indx):
     if not len(names):
         return
     total_size = 0
-    user_sizes = dict()
+    user_sizes = collections.defaultdict(int)
+    get_info = indx.info
     for name in names:
-        obj = indx[name]
-        size = obj.size
-        try:
-            user_sizes[obj.username] += size
-        except KeyError:
-            user_sizes[obj.username] = size
+        info = get_info(name)
+        size = info.size
+        user_sizes[info.username] += size
         total_size += size
     for user in user_sizes:
-        print("# %s:\t%s" % (user,
-                             _pretty_print_size(user_sizes[user])))
-    print("# Total:\t%s" % _pretty_print_size(total_size))
+        print(f"# {user}:\t{_pretty_print_size(user_sizes[user])}")
+    print(f"# Total:\t{_pretty_print_size(total_size)}")
 
-def compare(source,target):
+def compare(source,target,workers=None,hash_algo="md5"):
     """
     """
-    source = index.FilesystemObjectIndex(source)
-    target = index.FilesystemObjectIndex(target)
-    diff = index.compare(source,target)
-    print("%d missing objects" % len(diff.missing))
-    _print_list(diff.missing)
-    print("%d additional objects" % len(diff.extra))
-    _print_list(diff.extra)
-    print("%d objects changed type" % len(diff.changed_type))
-    _print_list(diff.changed_type)
-    print("%d objects changed size" % len(diff.changed_size))
-    _print_list(diff.changed_size)
-    print("%d objects changed MD5" % len(diff.changed_md5))
-    _print_list(diff.changed_md5)
-    print("%d objects changed time" % len(diff.changed_time))
-    _print_list(diff.changed_time)
-    print("%d objects changed link" % len(diff.changed_link))
-    _print_list(diff.changed_link)
-    print("%d restricted objects (source)" % len(diff.restricted_source))
-    _print_list(diff.restricted_source)
-    print("%d restricted objects (target)" % len(diff.restricted_target))
-    _print_list(diff.restricted_target)
+    source = index.FilesystemObjectIndex(source,workers=workers)
+    target = index.FilesystemObjectIndex(target,workers=workers)
+    diff = index.compare(source,target,workers=workers,
+                         hash_algo=hash_algo)
+    for label,names in (
+            ("%d missing objects",diff.missing),
+            ("%d additional objects",diff.extra),
+            ("%d objects changed type",diff.changed_type),
+            ("%d objects changed size",diff.changed_size),
+            ("%%d objects changed %s" % hash_algo.upper(),
+             diff.changed_md5),
+            ("%d objects changed time",diff.changed_time),
+            ("%d objects changed link",diff.changed_link),
+            ("%d restricted objects (source)",diff.restricted_source),
+            ("%d restricted objects (target)",diff.restricted_target)):
+        sys.stdout.write("%s\n" % (label % len(names)))
+        _print_list(names)
 
-def check_accessibility(dirn):
+def check_accessibility(dirn,workers=None):
     """
     """
-    indx = index.FilesystemObjectIndex(dirn)
+    indx = index.FilesystemObjectIndex(dirn,workers=workers)
     inaccessible = index.check_accessibility(indx)
-    print("%d inaccessible objects" % len(inaccessible))
-    for name in inaccessible:
-        obj = indx[name]
-        print("\t%s %s:%s\t%s" % (obj.linux_permissions,
-                                  obj.username,
-                                  obj.groupname,
-                                  name))
+    print(f"{len(inaccessible)} inaccessible objects")
+    with _BufferedPrinter() as out:
+        for name in inaccessible:
+            obj = indx[name]
+            out.print(f"\t{obj.linux_permissions} "
+                      f"{obj.username}:{obj.groupname}\t{name}")
 
 def find(dirn,exts=None,users=None,size=None,nocompressed=False,
          nosymlinks=False,only_hidden=False,long_listing=False,
-         full_paths=False):
+         full_paths=False,use_snapshot=False,workers=None):
     """
     """
-    indx = index.FilesystemObjectIndex(dirn)
+    indx = index.FilesystemObjectIndex(dirn,workers=workers,
+                                       use_snapshot=use_snapshot)
     matches = index.find(indx,exts=exts,users=users,
                          size=size,nocompressed=nocompressed,
                          nosymlinks=nosymlinks,
                          only_hidden=only_hidden)
-    print("%d matching objects" % len(matches))
-    for name in matches:
-        obj = indx[name]
-        if full_paths:
-            path = os.path.abspath(os.path.join(dirn,name))
-        else:
-            path = name
-        output = "%s%s" % (path,
-                        (" -> %s" % obj.raw_symlink_target)
-                        if obj.islink else "")
-        if long_listing:
-            output = "%s\t%s\t%s" % (obj.username,
-                                     _pretty_print_size(obj.size),
-                                     output)
-        print(output)
+    print(f"{len(matches)} matching objects")
+    if full_paths:
+        top_dirn = os.path.abspath(dirn)
+    get_info = indx.info
+    with _BufferedPrinter() as out:
+        for name in matches:
+            info = get_info(name)
+            if full_paths:
+                path = os.path.join(top_dirn,name)
+            else:
+                path = name
+            if info.islink:
+                output = f"{path} -> {info.symlink_target}"
+            else:
+                output = path
+            if long_listing:
+                output = (f"{info.username}\t"
+                          f"{_pretty_print_size(info.size)}\t{output}")
+            out.print(output)
     if long_listing:
         _summarise_find(matches,indx)
@@ -9,23 +9,85 @@ Indexing classes and functions
 """
 
 import os
+import sys
 import stat
 import collections
+import array
+import bisect
+import enum
+import time
+import functools
 import hashlib
+import struct
+import pickle
 import pwd
 import grp
+import concurrent.futures
 
 # Constants
 MD5_BLOCK_SIZE = 1024*1024
 COMPRESSED_FILE_EXTENSIONS = ('gz','bz2')
+_COMPRESSED_FILE_EXTENSIONS = frozenset(COMPRESSED_FILE_EXTENSIONS)
+WALK_THREADS = 8
+WALK_MIN_FANOUT = 4
+WALK_PREFETCH = 4
+WALK_MAX_PENDING = 2
+SNAPSHOT_VERSION = 2
+SNAPSHOT_MTIME_RESOLUTION = 2.0
+
+# Fetch metadata using statx only if explicitly requested (it's
+# slower than os.lstat via ctypes), in which case the module is
+# only imported (and statx probed for) on demand
+if os.environ.get("STOKER_USE_STATX") == "1":
+    from . import _statx
+    _USE_STATX = _statx.HAVE_STATX
+else:
+    _USE_STATX = False
+
+# hashlib.file_digest is only available from Python 3.11
+_file_digest = getattr(hashlib,'file_digest',None)
+
+# Effective identity of the current user (see 'refresh_identity')
+_MY_UID = os.geteuid()
+_MY_GROUPS = frozenset(os.getgroups()) | frozenset((os.getegid(),))
+
+# Stat information held for each object in an index
+IndexedStat = collections.namedtuple(
+    "IndexedStat",
+    ['st_mode',
+     'st_uid',
+     'st_gid',
+     'st_size',
+     'st_mtime',],)
+_MISSING_STAT = IndexedStat(0,0,0,0,0.0)
+
+# Summary information for listing an object in an index
+IndexedInfo = collections.namedtuple(
+    "IndexedInfo",
+    ['islink',
+     'size',
+     'username',
+     'symlink_target',],)
 
 # File types
-class FilesystemObjectType(object):
-    FILE = 0
-    DIRECTORY = 1
-    SYMLINK = 2
-    MISSING = 3
-    UNKNOWN = 4
+# The values for existing objects are the corresponding
+# file type bits from st_mode (as given by stat.S_IFMT)
+class FilesystemObjectType(enum.IntEnum):
+    FILE = stat.S_IFREG
+    DIRECTORY = stat.S_IFDIR
+    SYMLINK = stat.S_IFLNK
+    MISSING = 0
+    UNKNOWN = -1
+
+# Lookup table for object types from the S_IFMT part of
+# the mode (a missing object has a mode of zero)
+_MODE_TO_TYPE = dict([(t.value,t) for t in FilesystemObjectType])
+
+# Lookup table for permission strings (e.g. 'rwxr-x---')
+# from the permission bits of the mode
+_PERMISSIONS = tuple([''.join([(c if (i >> (8-j)) & 1 else '-')
+                               for j,c in enumerate('rwxrwxrwx')])
+                      for i in range(0o1000)])
 
 class FilesystemObjectStat(object):
     """
@@ -51,38 +113,99 @@ class FilesystemObjectStat(object):
 
     >>> os.lstat("test.txt").st_mtime
     1525350206.9344375
+
+    If the result of os.lstat has already been obtained
+    (e.g. from an os.DirEntry) then it can be supplied via
+    the 'st' argument, in which case no further system
+    call is made. Stat information supplied from an index
+    (or fetched using statx, see '_lstat') only holds a
+    subset of the attributes (mode, uid, gid, size and
+    mtime, plus dev for statx); None is returned for the
+    others.
     """
-    def __init__(self,path):
-        try:
-            self._st = os.lstat(path)
-        except OSError:
-            self._st = None
+    __slots__ = ('_st',)
+
+    def __init__(self,path,st=None):
+        if st is None:
+            try:
+                st = _lstat(path)
+            except OSError:
+                pass
+        self._st = st
 
     def get(self,attr):
+        if self._st is None:
+            return None
         try:
             return getattr(self._st,"st_%s" % attr)
-        except Exception as ex:
-            if self._st is None:
+        except AttributeError:
+            if hasattr(os.stat_result,"st_%s" % attr):
+                # Valid attribute which isn't held
                 return None
-            else:
-                raise ex
+            raise
 
 class FilesystemObject(object):
     """
     Store information about file system object
+
+    If the result of os.lstat for the object has already
+    been obtained then it can be supplied via the 'st'
+    argument; alternatively if an os.DirEntry instance for
+    the object is supplied via the 'dirent' argument (e.g.
+    from os.scandir) then the stat information is fetched
+    from that.
+
+    The 'exists', 'islink', 'isfile', 'isdir' and 'type'
+    attributes are set on construction from the mode in the
+    stat information, rather than by querying the file
+    system again each time they are accessed.
     """
-    def __init__(self,path):
+    __slots__ = ('path',
+                 'stat',
+                 'exists',
+                 'islink',
+                 'isfile',
+                 'isdir',
+                 'type',)
+
+    def __init__(self,path,dirent=None,st=None):
         """
         """
-        self.path = os.path.abspath(path)
-        self.stat = FilesystemObjectStat(self.path)
-        self._exists = None
+        if st is None and dirent is not None:
+            st = _dirent_lstat(dirent)
+        self._setup(os.path.abspath(path),st)
 
-    @property
-    def exists(self):
-        if self._exists is None:
-            self._exists = os.path.lexists(self.path)
-        return self._exists
+    @classmethod
+    def _from_abspath(cls,path,st=None):
+        """
+        Create a FilesystemObject from a normalised absolute path
+
+        Internal alternative constructor for callers (such as
+        FilesystemObjectIndex) which already have a normalised
+        absolute path, so the path isn't normalised again.
+        """
+        obj = cls.__new__(cls)
+        obj._setup(path,st)
+        return obj
+
+    def _setup(self,path,st):
+        """
+        Set the path and the stat-derived attributes
+        """
+        self.path = path
+        self.stat = FilesystemObjectStat(path,st=st)
+        # Determine the object type from the mode
+        st = self.stat._st
+        if st is None:
+            mode = 0
+        else:
+            mode = st.st_mode
+        self.exists = (st is not None)
+        self.islink = stat.S_ISLNK(mode)
+        self.isfile = stat.S_ISREG(mode)
+        self.isdir = stat.S_ISDIR(mode)
+        self.type = _MODE_TO_TYPE.get(stat.S_IFMT(mode),
+                                      FilesystemObjectType.UNKNOWN)
 
     @property
     def timestamp(self):
@@ -101,10 +224,7 @@ class FilesystemObject(object):
         uid = self.uid
         if uid is None:
             return None
-        try:
-            return pwd.getpwuid(int(uid)).pw_name
-        except (KeyError,ValueError,OverflowError):
-            return uid
+        return _username(uid)
 
     @property
     def gid(self):
@@ -115,40 +235,8 @@ class FilesystemObject(object):
         gid = self.gid
         if gid is None:
             return None
-        try:
-            return grp.getgrgid(int(gid)).gr_name
-        except (KeyError,ValueError,OverflowError):
-            return gid
+        return _groupname(gid)
     
-    @property
-    def islink(self):
-        return os.path.islink(self.path)
-
-    @property
-    def isfile(self):
-        if not self.islink:
-            return os.path.isfile(self.path)
-        return False
-
-    @property
-    def isdir(self):
-        if not self.islink:
-            return os.path.isdir(self.path)
-        return False
-
-    @property
-    def type(self):
-        if not self.exists:
-            return FilesystemObjectType.MISSING
-        if self.isfile:
-            return FilesystemObjectType.FILE
-        elif self.isdir:
-            return FilesystemObjectType.DIRECTORY
-        elif self.islink:
-            return FilesystemObjectType.SYMLINK
-        else:
-            return FilesystemObjectType.UNKNOWN
-
     @property
     def raw_symlink_target(self):
         if self.exists:
@@ -158,124 +246,729 @@ class FilesystemObject(object):
 
     @property
     def ishidden(self):
-        for ele in self.path.split(os.sep):
-            if ele.startswith('.'):
-                return True
-        return False
+        return _ishidden(self.path)
 
     @property
     def isaccessible(self):
         if not self.exists:
             return False
-        st_mode = self.stat.get("mode")
-        if self.uid == os.getuid():
-            return bool(st_mode & stat.S_IRUSR)
-        if self.gid in os.getgroups():
-            return bool(st_mode & stat.S_IRGRP)
-        return bool(st_mode & stat.S_IROTH)
+        return _isaccessible(self.stat.get("mode"),self.uid,self.gid)
 
     @property
     def md5sum(self):
+        return self.checksum("md5")
+
+    def checksum(self,hash_algo="md5"):
+        """
+        Return checksum for the object contents
+
+        'hash_algo' can be any algorithm name supported by
+        hashlib (e.g. 'md5', 'sha1', 'blake2b'). Returns None
+        if the object doesn't exist.
+        """
         if not self.exists:
             return None
-        chksum = hashlib.md5()
-        with open(self.path,"rb",buffering=MD5_BLOCK_SIZE) as fp:
-            for block in iter(fp.read,''):
-                if block:
-                    chksum.update(block)
-                else:
-                    break
+        with open(self.path,"rb",buffering=0) as fp:
+            _advise_sequential(fp.fileno())
+            if _file_digest is not None:
+                # Reads into a single reusable buffer
+                return _file_digest(fp,hash_algo).hexdigest()
+            chksum = hashlib.new(hash_algo)
+            for block in iter(lambda: fp.read(MD5_BLOCK_SIZE),b''):
+                chksum.update(block)
         return chksum.hexdigest()
 
     @property
     def linux_permissions(self):
         if not self.exists:
             return None
-        st_mode = self.stat.get("mode")
-        perms = "%s%s%s%s%s%s%s%s%s" % \
-                (('r' if st_mode & stat.S_IRUSR else '-'),
-                 ('w' if st_mode & stat.S_IWUSR else '-'),
-                 ('x' if st_mode & stat.S_IXUSR else '-'),
-                 ('r' if st_mode & stat.S_IRGRP else '-'),
-                 ('w' if st_mode & stat.S_IWGRP else '-'),
-                 ('x' if st_mode & stat.S_IXGRP else '-'),
-                 ('r' if st_mode & stat.S_IROTH else '-'),
-                 ('w' if st_mode & stat.S_IWOTH else '-'),
-                 ('x' if st_mode & stat.S_IXOTH else '-'))
-        return perms
+        return _PERMISSIONS[self.stat.get("mode") & 0o777]
 
     @property
     def extension(self):
-        return '.'.join(os.path.basename(self.path).split('.')[1:])
+        return _extension(self.path)
 
     @property
     def type_extension(self):
-        if self.iscompressed:
-            try:
-                return self.extension.split('.')[-2]
-            except IndexError:
-                return ""
-        else:
-            return self.extension.split('.')[-1]
+        return _type_extension(self.path)
 
     @property
     def iscompressed(self):
-        return (self.path.split('.')[-1] in COMPRESSED_FILE_EXTENSIONS)
+        return _iscompressed(self.path)
 
 class FilesystemObjectIndex(object):
     """
     Index of information about objects in a directory
+
+    The directory tree is scanned using a pool of worker
+    threads when the top level of the tree contains more
+    than WALK_MIN_FANOUT objects; otherwise (or if 'workers'
+    is set to 1) it is scanned serially. The number of
+    workers defaults to the value of the STOKER_WALK_THREADS
+    environment variable if this is set, or WALK_THREADS
+    otherwise.
+
+    If the STOKER_SORT_BY_INODE environment variable is set
+    to 1 then the contents of each directory are scanned in
+    inode order (see '_scan_dir'), which can speed up
+    scanning on rotating disks.
+
+    The names of the objects in the index are returned in
+    sorted order (regardless of the order in which they were
+    scanned).
+
+    If 'use_snapshot' is True then a snapshot of the index is
+    saved when it is built (see 'snapshot_file'), and the
+    snapshot from a previous build is used to avoid
+    rescanning directories which haven't been modified
+    since: the objects in those directories are taken from
+    the snapshot without being checked again, so changes to
+    the size or timestamp of existing files in unmodified
+    directories won't be picked up.
+
+    Internally the metadata for the objects is stored as a
+    set of parallel arrays (one per attribute) rather than
+    as a FilesystemObject instance per object, to reduce the
+    memory required for large indexes; FilesystemObject
+    instances are created on demand by '__getitem__'.
     """
-    def __init__(self,dirn):
+    def __init__(self,dirn,workers=None,use_snapshot=False):
         """
         """
         self._dirn = os.path.abspath(dirn)
-        self._objects = {}
-        self._names = []
+        # Prefix for making full paths from relative names
+        self._prefix = os.path.join(self._dirn,'')
+        self._use_snapshot = use_snapshot
+        self._rows = {}
+        self._sorted_names = []
+        self._symlink_targets = {}
+        self._fingerprint = None
+        self._mode = array.array('I')
+        self._uid = array.array('I')
+        self._gid = array.array('I')
+        self._size = array.array('q')
+        self._mtime = array.array('d')
+        if workers is None:
+            workers = _env_int("STOKER_WALK_THREADS",WALK_THREADS)
+        self._workers = max(1,workers)
+        self._sort_by_inode = bool(_env_int("STOKER_SORT_BY_INODE",0))
         self._build()
 
     def __len__(self):
-        return len(self._objects)
+        return len(self._rows)
 
     def __contains__(self,name):
-        return (name in self._names)
+        return (name in self._rows)
 
     def __getitem__(self,name):
-        return self._objects[name]
+        return FilesystemObject._from_abspath(
+            self._prefix + name,
+            st=self._stat(self._rows[name]))
 
     @property
     def names(self):
         """
-        Return list of object names
+        Return sorted list of object names
         """
-        return [x for x in self._names]
-    
+        return list(self._sorted_names)
+
+    def info(self,name):
+        """
+        Return summary information for listing an object
+
+        Returns an IndexedInfo tuple with the symlink status,
+        size, owner's user name and symlink target (or None
+        if not a symlink) for the named object, taken directly
+        from the index without creating a FilesystemObject.
+        """
+        row = self._rows[name]
+        mode = self._mode[row]
+        if not mode:
+            return IndexedInfo(False,None,None,None)
+        return IndexedInfo(islink=stat.S_ISLNK(mode),
+                           size=self._size[row],
+                           username=_username(self._uid[row]),
+                           symlink_target=self._symlink_targets.get(name))
+
+    def checksum(self,name,hash_algo="md5"):
+        """
+        Return checksum for the contents of an object
+
+        The checksum is computed from the current contents of
+        the file each time, using the FilesystemObject
+        'checksum' method.
+        """
+        return self[name].checksum(hash_algo)
+
+    def subtree(self,prefix):
+        """
+        Return sorted list of names of objects under a directory
+
+        Returns the names of all the objects below the
+        directory 'prefix' (a path relative to the top of
+        the index); the directory itself is not included.
+        If 'prefix' is empty then all names are returned.
+
+        The names are located using a binary search of the
+        sorted list of names, rather than by checking every
+        name in the index.
+        """
+        prefix = prefix.strip(os.sep)
+        if not prefix:
+            return list(self._sorted_names)
+        # Names starting with 'prefix/' form a contiguous
+        # range in the sorted names, ending before the first
+        # name which starts with 'prefix' plus the character
+        # following the separator
+        start = prefix + os.sep
+        end = prefix + chr(ord(os.sep)+1)
+        lo = bisect.bisect_left(self._sorted_names,start)
+        hi = bisect.bisect_left(self._sorted_names,end,lo)
+        return self._sorted_names[lo:hi]
+
     def _build(self):
         """
         Build index from filesystem
         """
         print("Indexing objects in %s" % self._dirn)
-        for d in os.walk(self._dirn):
-            for f in d[1]:
-                self._add_object(d[0],f)
-            for f in d[2]:
-                self._add_object(d[0],f)
+        scan_time = time.time()
+        try:
+            root_mtime = os.stat(self._dirn).st_mtime
+        except OSError:
+            root_mtime = None
+        if self._use_snapshot:
+            snapshot = self._load_snapshot()
+        else:
+            snapshot = None
+        objects,subdirs = _scan_dir(self._dirn,'',root_mtime,snapshot,
+                                    self._sort_by_inode)
+        for relpath,st in objects:
+            self._add_object(relpath,st)
+        if self._workers > 1 and len(objects) > WALK_MIN_FANOUT:
+            walk = self._walk_parallel
+        else:
+            walk = self._walk
+        for relpath,st in walk(subdirs,snapshot):
+            self._add_object(relpath,st)
+        self._sorted_names = sorted(self._rows)
+        self._read_symlinks()
+        self._fingerprint = self._compute_fingerprint()
         print("Added %d objects" % len(self))
+        if self._use_snapshot:
+            self._save_snapshot(root_mtime,scan_time)
+
+    def _walk(self,subdirs,snapshot=None):
+        """
+        Scan directories serially
+
+        Performs a depth-first traversal using an explicit
+        stack, yielding (relpath,st) pairs for
+        the contents of each of the directories in 'subdirs'
+        (and of their subdirectories).
+
+        Read-ahead hints are issued for up to WALK_PREFETCH
+        directories ahead of the one currently being scanned
+        (see '_prefetch_dir').
+        """
+        # Subdirectories are pushed in reverse so that they're
+        # popped in the order they were returned
+        sort_by_inode = self._sort_by_inode
+        stack = list(reversed(subdirs))
+        prefetched = set()
+        while stack:
+            # Hint the next few directories which will be
+            # scanned, so the kernel can start reading them in
+            # while the current one is processed
+            for d in stack[-WALK_PREFETCH:]:
+                if d[0] not in prefetched:
+                    _prefetch_dir(d[0])
+                    prefetched.add(d[0])
+            d = stack.pop()
+            prefetched.discard(d[0])
+            objects,subdirs = _scan_dir(*d,snapshot=snapshot,
+                                        sort_by_inode=sort_by_inode)
+            for relpath_st in objects:
+                yield relpath_st
+            stack.extend(reversed(subdirs))
+
+    def _walk_parallel(self,subdirs,snapshot=None):
+        """
+        Scan directories using a pool of worker threads
+
+        Each directory is scanned as a separate task, and
+        the subdirectories that it contains are queued to be
+        scanned as new tasks as each task completes. Most of
+        the time in each task is spent in system calls (which
+        release the GIL) so the scans run concurrently.
+
+        At most WALK_MAX_PENDING tasks per worker are submitted
+        to the pool at any one time; the remaining directories
+        are held in a queue until there is space for them, so
+        that the number of outstanding futures (and of results
+        waiting to be consumed) stays bounded.
+
+        Yields the same (relpath,st) pairs as
+        the '_walk' method (but in no particular order).
+        """
+        max_pending = self._workers*WALK_MAX_PENDING
+        sort_by_inode = self._sort_by_inode
+        queued = list(reversed(subdirs))
+        pending = set()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._workers) as executor:
+            while queued or pending:
+                # Top up the tasks in the pool
+                while queued and len(pending) < max_pending:
+                    pending.add(executor.submit(
+                        _scan_dir,*queued.pop(),
+                        snapshot=snapshot,
+                        sort_by_inode=sort_by_inode))
+                done,pending = concurrent.futures.wait(
+                    pending,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    objects,subdirs = future.result()
+                    queued.extend(reversed(subdirs))
+                    for relpath_st in objects:
+                        yield relpath_st
+
+    def _read_symlinks(self):
+        """
+        Read the targets of all the symlinks in the index
+
+        The targets are read in a single pass once the
+        directory tree has been scanned (using the worker
+        threads if there are enough links), and are stored
+        in the '_symlink_targets' dictionary.
+        """
+        names = [name for name,row in self._rows.items()
+                 if stat.S_ISLNK(self._mode[row])]
+        prefix = self._prefix
+        paths = [prefix + name for name in names]
+        if self._workers > 1 and len(paths) > WALK_MIN_FANOUT:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._workers) as executor:
+                targets = list(executor.map(_readlink,paths))
+        else:
+            targets = [_readlink(path) for path in paths]
+        self._symlink_targets = dict(zip(names,targets))
+
+    @property
+    def snapshot_file(self):
+        """
+        Return the path to the snapshot file for the index
+
+        Snapshots are stored under the 'stoker' subdirectory
+        of the user's cache directory (i.e. $XDG_CACHE_HOME,
+        or $HOME/.cache if this isn't set), with a name which
+        is derived from the device and path of the indexed
+        directory.
+        """
+        try:
+            dev = os.stat(self._dirn).st_dev
+        except OSError:
+            dev = 0
+        key = hashlib.sha1(("%d:%s" % (dev,self._dirn)).encode(
+            'utf-8','surrogateescape')).hexdigest()
+        cache_dir = os.environ.get("XDG_CACHE_HOME",
+                                   os.path.join(os.path.expanduser("~"),
+                                                ".cache"))
+        return os.path.join(cache_dir,"stoker","%s.idx" % key)
+
+    def _load_snapshot(self):
+        """
+        Load the snapshot saved by a previous build
+
+        Returns a dictionary where the keys are the relative
+        paths of the directories in the snapshot (with the top
+        level directory being the empty string), and the
+        values are tuples (mtime,contents) where 'mtime' is
+        the modification time of the directory and 'contents'
+        is a list of (name,st) pairs for the objects that it
+        contained.
+
+        Directories which were modified less than
+        SNAPSHOT_MTIME_RESOLUTION seconds before the snapshot's
+        scan started aren't included: entries could have been
+        added to them later in the same timestamp tick without
+        changing their modification time, so they must always
+        be scanned again.
+
+        Returns None if there is no usable snapshot.
+        """
+        try:
+            with open(self.snapshot_file,'rb') as fp:
+                data = pickle.load(fp)
+            if data['version'] != SNAPSHOT_VERSION or \
+               data['dirn'] != self._dirn:
+                return None
+            names = data['names']
+            mode = data['mode']
+            uid = data['uid']
+            gid = data['gid']
+            size = data['size']
+            mtime = data['mtime']
+            cutoff = data['scan_time'] - SNAPSHOT_MTIME_RESOLUTION
+        except Exception:
+            return None
+        print("Using snapshot %s" % self.snapshot_file)
+        snapshot = {}
+        root_mtime = data['root_mtime']
+        if root_mtime is not None and root_mtime < cutoff:
+            snapshot[''] = (root_mtime,[])
+        for row,name in enumerate(names):
+            if stat.S_ISDIR(mode[row]) and mtime[row] < cutoff:
+                snapshot[name] = (mtime[row],[])
+        for row,name in enumerate(names):
+            reldirn,basename = os.path.split(name)
+            try:
+                snapshot[reldirn][1].append(
+                    (basename,IndexedStat(st_mode=mode[row],
+                                          st_uid=uid[row],
+                                          st_gid=gid[row],
+                                          st_size=size[row],
+                                          st_mtime=mtime[row])))
+            except KeyError:
+                pass
+        return snapshot
+
+    def _save_snapshot(self,root_mtime,scan_time):
+        """
+        Save a snapshot of the index for use by later builds
 
-    def _add_object(self,*args):
+        'scan_time' is the time that the scan of the
+        directory started (see '_load_snapshot'). Errors
+        writing the snapshot are ignored.
+        """
+        snapshot_file = self.snapshot_file
+        data = { 'version': SNAPSHOT_VERSION,
+                 'dirn': self._dirn,
+                 'root_mtime': root_mtime,
+                 'scan_time': scan_time,
+                 'names': list(self._rows),
+                 'mode': self._mode,
+                 'uid': self._uid,
+                 'gid': self._gid,
+                 'size': self._size,
+                 'mtime': self._mtime, }
+        tmp_file = "%s.%d.tmp" % (snapshot_file,os.getpid())
+        try:
+            os.makedirs(os.path.dirname(snapshot_file),exist_ok=True)
+            with open(tmp_file,'wb') as fp:
+                pickle.dump(data,fp,protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file,snapshot_file)
+        except OSError:
+            pass
+
+    def _compute_fingerprint(self):
+        """
+        Return a digest summarising the contents of the index
+
+        The digest covers the name, size, modification time
+        and mode of each object (in sorted name order), plus
+        the targets of symlinks; two indexes with the same
+        fingerprint have identical metadata (but not
+        necessarily identical file contents).
+        """
+        fingerprint = hashlib.blake2b(digest_size=16)
+        pack = struct.Struct('<qdI').pack
+        for name in self._sorted_names:
+            row = self._rows[name]
+            fingerprint.update(name.encode('utf-8','surrogateescape'))
+            fingerprint.update(pack(self._size[row],
+                                    self._mtime[row],
+                                    self._mode[row]))
+            target = self._symlink_targets.get(name)
+            if target is not None:
+                fingerprint.update(
+                    target.encode('utf-8','surrogateescape'))
+            fingerprint.update(b'\0')
+        return fingerprint.digest()
+
+    def _add_object(self,relpath,st):
         """
         Store info about a filesystem object
+
+        The relative path is interned, so that indexes of
+        similar directory trees share a single copy of each
+        name (and name lookups between them can match on
+        identity).
+        """
+        self._rows[sys.intern(relpath)] = len(self._rows)
+        if st is None:
+            # Object has gone away since it was scanned
+            st = _MISSING_STAT
+        self._mode.append(st.st_mode)
+        self._uid.append(st.st_uid)
+        self._gid.append(st.st_gid)
+        self._size.append(st.st_size)
+        self._mtime.append(st.st_mtime)
+
+    def _stat(self,row):
         """
-        # Get absolute and relative paths
-        path = os.path.normpath(os.path.join(*args))
-        relpath = os.path.relpath(path,self._dirn)
-        # Store the object
-        self._objects[relpath] = FilesystemObject(path)
-        self._names.append(relpath) # Use a set instead?
+        Return the stored stat information for a row
+
+        Returns None if the object was missing when it was
+        scanned.
+        """
+        mode = self._mode[row]
+        if not mode:
+            return None
+        return IndexedStat(st_mode=mode,
+                           st_uid=self._uid[row],
+                           st_gid=self._gid[row],
+                           st_size=self._size[row],
+                           st_mtime=self._mtime[row])
+
+def _scan_dir(dirn,reldirn,mtime=None,snapshot=None,sort_by_inode=False):
+    """
+    Scan the contents of a single directory using os.scandir
+
+    Returns a tuple (objects,subdirs), where 'objects' is a
+    list of (relpath,st) pairs for each object
+    in the directory 'dirn' (with 'relpath' being relative
+    to the top of the index, given by joining 'reldirn' and
+    the object name), and 'subdirs' is a list of
+    (path,relpath,mtime) tuples for each subdirectory which
+    should be scanned in turn. 'st' is the stat information
+    for the object (or None if it couldn't be obtained).
+
+    If a snapshot (as returned by the '_load_snapshot' method
+    of FilesystemObjectIndex) is supplied and contains the
+    directory with the same modification time as 'mtime'
+    then the contents are taken from the snapshot instead;
+    only the subdirectories are checked again (so that any
+    changes within them can be detected).
+
+    If 'sort_by_inode' is True then the entries are fetched
+    in order of their inode numbers (which are available
+    from the directory listing without a system call), and
+    subdirectories are returned in the same order; on
+    rotating disks this reduces seeking when reading the
+    inodes.
+
+    Directories which cannot be read are silently skipped
+    (as for os.walk).
+    """
+    objects = []
+    subdirs = []
+    # Paths are built by concatenating onto these prefixes
+    # rather than using os.path.join for each object
+    prefix = os.path.join(dirn,'')
+    relprefix = os.path.join(reldirn,'') if reldirn else ''
+    if snapshot is not None and mtime is not None:
+        try:
+            snapshot_mtime,contents = snapshot[reldirn]
+        except KeyError:
+            contents = None
+        if contents and snapshot_mtime == mtime:
+            for name,st in contents:
+                path = prefix + name
+                relpath = relprefix + name
+                if stat.S_ISDIR(st.st_mode):
+                    try:
+                        st = _lstat(path)
+                    except OSError:
+                        continue
+                    subdirs.append((path,relpath,st.st_mtime))
+                objects.append((relpath,st))
+            return (objects,subdirs)
+    try:
+        with os.scandir(dirn) as it:
+            dirents = list(it)
+    except OSError:
+        return (objects,subdirs)
+    if sort_by_inode:
+        dirents.sort(key=os.DirEntry.inode)
+    for dirent in dirents:
+        relpath = relprefix + dirent.name
+        st = _dirent_lstat(dirent)
+        objects.append((relpath,st))
+        if st is not None and stat.S_ISDIR(st.st_mode):
+            subdirs.append((dirent.path,relpath,st.st_mtime))
+    return (objects,subdirs)
+
+def _env_int(name,default):
+    """
+    Return the integer value of an environment variable
+
+    Returns 'default' if the variable isn't set, or if its
+    value isn't an integer (in which case a warning is also
+    printed).
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print("WARNING: ignoring invalid value for %s: '%s'" %
+              (name,value),file=sys.stderr)
+        return default
+
+def _prefetch_dir(path):
+    """
+    Advise the kernel that a directory will be read soon
+
+    Issues a POSIX_FADV_WILLNEED hint for the directory, so
+    that its entries can be read in asynchronously. This is
+    only a hint: nothing is done if posix_fadvise isn't
+    available, and any errors are ignored.
+    """
+    if not hasattr(os,'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path,os.O_RDONLY|os.O_DIRECTORY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd,0,0,os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _ishidden(path):
+    """
+    Check if any component of a path starts with '.'
+    """
+    for ele in path.split(os.sep):
+        if ele.startswith('.'):
+            return True
+    return False
+
+def _extension(path):
+    """
+    Return the extension of a path
+
+    The extension is everything after the first '.' in the
+    final component of the path (e.g. 'fastq.gz' for
+    'PJB_R1.fastq.gz').
+    """
+    return '.'.join(os.path.basename(path).split('.')[1:])
+
+def _iscompressed(path):
+    """
+    Check if a path has a compressed file extension
+    """
+    name,sep,ext = path.rpartition('.')
+    return (bool(sep) and os.sep not in ext and
+            ext in _COMPRESSED_FILE_EXTENSIONS)
+
+def _type_extension(path):
+    """
+    Return the extension indicating the type of a path
 
-def compare(src,tgt):
+    This is the final extension, or the one before it if
+    the final extension indicates compression (e.g. 'fastq'
+    for 'PJB_R1.fastq.gz').
+    """
+    # Split extensions off from the end of the path, rather
+    # than splitting the whole name
+    base,sep,ext = path.rpartition('.')
+    if not sep or os.sep in ext:
+        return ""
+    if ext in _COMPRESSED_FILE_EXTENSIONS:
+        base,sep,ext = base.rpartition('.')
+        if not sep or os.sep in ext:
+            return ""
+    return ext
+
+@functools.lru_cache(maxsize=4096)
+def _username(uid):
+    """
+    Return the user name for a UID (or the UID if unknown)
+
+    Results are cached, since looking up user names can be
+    slow (e.g. when accounts are held in LDAP) and large
+    numbers of objects are typically owned by only a few
+    users.
+    """
+    try:
+        return pwd.getpwuid(int(uid)).pw_name
+    except (KeyError,ValueError,OverflowError):
+        return uid
+
+@functools.lru_cache(maxsize=4096)
+def _groupname(gid):
+    """
+    Return the group name for a GID (or the GID if unknown)
+
+    Results are cached (see '_username').
+    """
+    try:
+        return grp.getgrgid(int(gid)).gr_name
+    except (KeyError,ValueError,OverflowError):
+        return gid
+
+def _advise_sequential(fd):
+    """
+    Advise the kernel that a file will be read sequentially
+
+    Issues a POSIX_FADV_SEQUENTIAL hint for the open file
+    descriptor 'fd', so that more aggressive read-ahead is
+    used. Nothing is done if posix_fadvise isn't available,
+    and any errors are ignored.
+    """
+    if not hasattr(os,'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd,0,0,os.POSIX_FADV_SEQUENTIAL)
+    except OSError:
+        pass
+
+def _readlink(path):
+    """
+    Return the target of a symlink, or None if it can't be read
+    """
+    try:
+        return os.readlink(path)
+    except OSError:
+        return None
+
+def _lstat(path):
+    """
+    Return the stat information for a path
+
+    Uses statx if the STOKER_USE_STATX environment variable
+    was set to 1 (and statx is available), otherwise
+    os.lstat. Raises OSError if the path can't be accessed.
+    """
+    if _USE_STATX:
+        return _statx.lstat(path)
+    return os.lstat(path)
+
+def _dirent_lstat(dirent):
+    """
+    Return the stat information for an os.DirEntry
+
+    Uses the (possibly cached) result of the DirEntry's
+    'stat' method, unless statx has been requested (see
+    '_lstat'). Returns None if the object no longer exists.
+    """
+    try:
+        if _USE_STATX:
+            return _statx.lstat(dirent.path)
+        return dirent.stat(follow_symlinks=False)
+    except OSError:
+        return None
+
+def compare(src,tgt,workers=None,hash_algo="md5"):
     """
     Compare two FilesystemObjectIndexes
+
+    The sorted names from the two indexes are walked in
+    step (as in a merge), so that missing, extra and common
+    objects are all identified in a single pass and the
+    lists in the returned results are sorted.
+
+    Checksums for files which need their contents checking
+    are computed once the walk is complete, using 'workers'
+    threads (defaults to the number of workers used for
+    the source index). By default these are MD5 sums, but
+    any algorithm supported by hashlib can be specified via
+    'hash_algo' (files with different checksums are still
+    reported in 'changed_md5').
     """
     # Define a named tuple to return the results with
     FilesystemObjectIndexComparison = collections.namedtuple(
@@ -289,58 +982,221 @@ def compare(src,tgt):
      'changed_md5',
      'changed_link',
      'changed_time',],)
-    # Missing and modified objects
-    missing = set()
-    changed_type = set()
-    changed_size = set()
-    changed_md5 = set()
-    changed_link = set()
-    changed_time = set()
-    restricted_src = set()
-    restricted_tgt = set()
-    for name in src.names:
-        src_obj = src[name]
-        if not src_obj.isaccessible:
-            restricted_src.add(name)
-        if name not in tgt:
-            missing.add(name)
+    # Results (each list is populated in sorted order)
+    missing = []
+    extra = []
+    changed_type = []
+    changed_size = []
+    changed_md5 = []
+    changed_link = []
+    changed_time = []
+    restricted_src = []
+    restricted_tgt = []
+    # Files which need their MD5 sums comparing
+    check_md5 = []
+    if workers is None:
+        workers = src._workers
+    # Metadata is compared directly using the arrays held
+    # by each index; FilesystemObject instances are only
+    # created where the file system needs to be consulted
+    # again (i.e. for MD5 sums)
+    src_rows = src._rows
+    src_mode,src_uid,src_gid = (src._mode,src._uid,src._gid)
+    src_size,src_mtime = (src._size,src._mtime)
+    tgt_rows = tgt._rows
+    tgt_mode,tgt_uid,tgt_gid = (tgt._mode,tgt._uid,tgt._gid)
+    tgt_size,tgt_mtime = (tgt._size,tgt._mtime)
+    # Local references to the functions used in the loops
+    # (avoids repeated global and attribute lookups)
+    isaccessible = _isaccessible
+    S_IFMT,S_ISREG,S_ISLNK = (stat.S_IFMT,stat.S_ISREG,stat.S_ISLNK)
+    # Indexes with identical metadata can only differ in the
+    # accessibility checks and the content of files, so only
+    # check those
+    if src._fingerprint == tgt._fingerprint:
+        for name in src._sorted_names:
+            i = src_rows[name]
+            j = tgt_rows[name]
+            mode = src_mode[i]
+            if not isaccessible(mode,src_uid[i],src_gid[i]):
+                restricted_src.append(name)
+            if not isaccessible(tgt_mode[j],tgt_uid[j],tgt_gid[j]):
+                restricted_tgt.append(name)
+            elif S_ISREG(mode):
+                check_md5.append(name)
+        changed_md5 = _changed_md5(src,tgt,check_md5,workers,hash_algo)
+        return FilesystemObjectIndexComparison(
+            missing=missing,
+            extra=extra,
+            restricted_source=restricted_src,
+            restricted_target=restricted_tgt,
+            changed_type=changed_type,
+            changed_size=changed_size,
+            changed_md5=changed_md5,
+            changed_link=changed_link,
+            changed_time=changed_time)
+    # Walk the sorted names from both indexes in step
+    src_names = src._sorted_names
+    tgt_names = tgt._sorted_names
+    nsrc = len(src_names)
+    ntgt = len(tgt_names)
+    isrc = 0
+    itgt = 0
+    while isrc < nsrc or itgt < ntgt:
+        if itgt == ntgt or \
+           (isrc < nsrc and src_names[isrc] < tgt_names[itgt]):
+            # Only in source (missing object)
+            name = src_names[isrc]
+            isrc += 1
+            i = src_rows[name]
+            if not isaccessible(src_mode[i],src_uid[i],src_gid[i]):
+                restricted_src.append(name)
+            missing.append(name)
+            continue
+        if isrc == nsrc or tgt_names[itgt] < src_names[isrc]:
+            # Only in target (extra object)
+            name = tgt_names[itgt]
+            itgt += 1
+            j = tgt_rows[name]
+            extra.append(name)
+            if not isaccessible(tgt_mode[j],tgt_uid[j],tgt_gid[j]):
+                restricted_tgt.append(name)
+            continue
+        # In both source and target
+        name = src_names[isrc]
+        isrc += 1
+        itgt += 1
+        i = src_rows[name]
+        j = tgt_rows[name]
+        mode = src_mode[i]
+        if not isaccessible(mode,src_uid[i],src_gid[i]):
+            restricted_src.append(name)
+        if not isaccessible(tgt_mode[j],tgt_uid[j],tgt_gid[j]):
+            restricted_tgt.append(name)
+        elif S_IFMT(mode) != S_IFMT(tgt_mode[j]):
+            changed_type.append(name)
         else:
-            tgt_obj = tgt[name]
-            if not tgt_obj.isaccessible:
-                restricted_tgt.add(name)
-            elif src_obj.type != tgt_obj.type:
-                changed_type.add(name)
-            else:
-                if src_obj.type == FilesystemObjectType.FILE:
-                    if src_obj.size != tgt_obj.size:
-                        changed_size.add(name)
-                    if src_obj.md5sum != tgt_obj.md5sum:
-                        changed_md5.add(name)
-                elif src_obj.type == FilesystemObjectType.SYMLINK:
-                    if src_obj.raw_symlink_target != tgt_obj.raw_symlink_target:
-                        changed_link.add(name)
-                if src_obj.timestamp != tgt_obj.timestamp:
-                    changed_time.add(name)
-    # Extra objects
-    extra = set()
-    for name in tgt.names:
-        if name not in src:
-            extra.add(name)
-        tgt_obj = tgt[name]
-        if not tgt_obj.isaccessible:
-            restricted_tgt.add(name)
+            if S_ISREG(mode):
+                if src_size[i] != tgt_size[j]:
+                    # Contents must differ if the sizes do, so
+                    # don't read the files to compute MD5 sums
+                    changed_size.append(name)
+                    changed_md5.append(name)
+                else:
+                    check_md5.append(name)
+            elif S_ISLNK(mode):
+                if src._symlink_targets.get(name) != \
+                   tgt._symlink_targets.get(name):
+                    changed_link.append(name)
+            if src_mtime[i] != tgt_mtime[j]:
+                changed_time.append(name)
+    # Check the contents of files
+    changed_md5.extend(_changed_md5(src,tgt,check_md5,workers,hash_algo))
+    changed_md5.sort()
     # Return the results
     return FilesystemObjectIndexComparison(
-        missing=sorted(list(missing)),
-        extra=sorted(list(extra)),
-        restricted_source=sorted(list(restricted_src)),
-        restricted_target=sorted(list(restricted_tgt)),
-        changed_type=sorted(list(changed_type)),
-        changed_size=sorted(list(changed_size)),
-        changed_md5=sorted(list(changed_md5)),
-        changed_link=sorted(list(changed_link)),
-        changed_time=sorted(list(changed_time)))
-            
+        missing=missing,
+        extra=extra,
+        restricted_source=restricted_src,
+        restricted_target=restricted_tgt,
+        changed_type=changed_type,
+        changed_size=changed_size,
+        changed_md5=changed_md5,
+        changed_link=changed_link,
+        changed_time=changed_time)
+
+def _changed_md5(src,tgt,names,workers=1,hash_algo="md5"):
+    """
+    Return the names of files with different checksums
+
+    Compares the checksums (MD5 sums by default, otherwise
+    using 'hash_algo') of the named files in the source and
+    target indexes, and returns a list of the names where
+    they differ (in the same order as 'names').
+
+    If 'workers' is greater than one then the files are
+    checked concurrently using a pool of threads (hashlib
+    releases the GIL while hashing, and the rest of the
+    time is spent reading the files). The source and target
+    copies of each file are checksummed as separate tasks,
+    submitted one after the other, so that both copies are
+    read at the same time (which keeps both devices busy
+    when the source and target are on different disks).
+    At most WALK_MAX_PENDING files per worker are submitted
+    ahead of the results being collected, so the number of
+    outstanding tasks stays bounded for large indexes.
+
+    Within a single call, files which are hard links to the
+    same inode (e.g. unchanged files in backups made with
+    'rsync --link-dest') are only read once.
+    """
+    # Checksums for this call only, keyed by inode
+    digests = {}
+    def checksum(indx,name):
+        try:
+            st = os.lstat(indx._prefix + name)
+        except OSError:
+            return indx.checksum(name,hash_algo)
+        key = (st.st_dev,st.st_ino)
+        try:
+            return digests[key]
+        except KeyError:
+            pass
+        digest = indx.checksum(name,hash_algo)
+        digests[key] = digest
+        return digest
+    if workers <= 1 or not names:
+        return [name for name in names
+                if checksum(src,name) != checksum(tgt,name)]
+    changed = []
+    max_pending = workers*WALK_MAX_PENDING
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers) as executor:
+        for name in names:
+            if len(pending) >= max_pending:
+                # Collect the oldest results (keeps the order)
+                done,src_sum,tgt_sum = pending.popleft()
+                if src_sum.result() != tgt_sum.result():
+                    changed.append(done)
+            pending.append((name,
+                            executor.submit(checksum,src,name),
+                            executor.submit(checksum,tgt,name)))
+        for name,src_sum,tgt_sum in pending:
+            if src_sum.result() != tgt_sum.result():
+                changed.append(name)
+    return changed
+
+def _isaccessible(mode,uid,gid):
+    """
+    Check if an object is readable by the current user
+
+    Takes the mode (i.e. st_mode) and the UID and GID of
+    the owner of the object; a mode of zero or None is
+    taken to mean that the object doesn't exist.
+    """
+    if not mode:
+        return False
+    if uid == _MY_UID:
+        return bool(mode & stat.S_IRUSR)
+    if gid in _MY_GROUPS:
+        return bool(mode & stat.S_IRGRP)
+    return bool(mode & stat.S_IROTH)
+
+def refresh_identity():
+    """
+    Update the cached identity of the current user
+
+    The effective UID and groups of the current user are
+    looked up once when the module is loaded and used for
+    all subsequent accessibility checks; long-running
+    processes which change their identity should call this
+    function afterwards.
+    """
+    global _MY_UID,_MY_GROUPS
+    _MY_UID = os.geteuid()
+    _MY_GROUPS = frozenset(os.getgroups()) | frozenset((os.getegid(),))
+
 def check_accessibility(indx):
     """
     Check objects in an ObjectIndex are accessible
@@ -360,37 +1216,44 @@ def find(indx,exts=None,users=None,size=None,only_hidden=False,
          nosymlinks=False,nocompressed=False):
     """
     Find matching objects in an ObjectIndex
+
+    The filters are applied directly to the names and the
+    metadata arrays held by the index, so FilesystemObject
+    instances aren't created for each object. Returns a
+    sorted list of the names of the matching objects.
     """
-    matches = list()
     if exts is None and \
        users is None and \
        size is None and \
        only_hidden is False:
-        return matches
+        return list()
+    names = indx._sorted_names
+    rows = indx._rows
+    mode = indx._mode
     if exts is not None:
-        exts = [x.strip('.') for x in exts.split(',')]
-        for name in indx.names:
-            obj = indx[name]
-            for ext in exts:
-                if ext == obj.type_extension:
-                    matches.append(name)
-                    break
-    else:
-        matches = indx.names
+        exts = set([x.strip('.') for x in exts.split(',')])
+        names = [name for name in names
+                 if _type_extension(name) in exts]
     if users is not None:
-        users = [x for x in users.split(',')]
-        matches = filter(lambda x: indx[x].username in users,
-                         matches)
+        users = set(users.split(','))
+        # Look up each distinct UID only once
+        uid = indx._uid
+        uids = set([u for u in set(uid) if _username(u) in users])
+        names = [name for name in names
+                 if mode[rows[name]] and uid[rows[name]] in uids]
     if size is not None:
-        matches = filter(lambda x: indx[x].isfile and indx[x].size >= size,
-                         matches)
+        sizes = indx._size
+        names = [name for name in names
+                 if stat.S_ISREG(mode[rows[name]]) and
+                 sizes[rows[name]] >= size]
     if only_hidden:
-        matches = filter(lambda x: indx[x].ishidden,
-                         matches)
+        # Objects are hidden if any part of their full path
+        # (including the indexed directory) is hidden
+        if not _ishidden(indx._dirn):
+            names = [name for name in names if _ishidden(name)]
     if nosymlinks:
-        matches = filter(lambda x: not indx[x].islink,
-                         matches)
+        names = [name for name in names
+                 if not stat.S_ISLNK(mode[rows[name]])]
     if nocompressed:
-        matches = filter(lambda x: not indx[x].iscompressed,
-                         matches)
-    return sorted(matches)
+        names = [name for name in names if not _iscompressed(name)]
+    return list(names)
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+#
+# Unit tests for the stoker cli module
+import unittest
+import argparse
+from stoker.cli import _size_arg
+from stoker.cli import _hash_arg
+
+#
+# Tests
+class TestSizeArg(unittest.TestCase):
+    def test_size_arg_bytes(self):
+        self.assertEqual(_size_arg("0"),0)
+        self.assertEqual(_size_arg("1023"),1023)
+
+    def test_size_arg_with_units(self):
+        self.assertEqual(_size_arg("2K"),2048)
+        self.assertEqual(_size_arg("3M"),3*1024*1024)
+        self.assertEqual(_size_arg("1G"),1024*1024*1024)
+
+    def test_size_arg_invalid(self):
+        for s in ("","K","1T","1.5K","abc"):
+            self.assertRaises(argparse.ArgumentTypeError,_size_arg,s)
+
+class TestHashArg(unittest.TestCase):
+    def test_hash_arg(self):
+        for s in ("md5","sha1","sha256","blake2b"):
+            self.assertEqual(_hash_arg(s),s)
+
+    def test_hash_arg_invalid(self):
+        for s in ("","foo","shake_128"):
+            self.assertRaises(argparse.ArgumentTypeError,_hash_arg,s)
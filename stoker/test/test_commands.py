@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+#
+# Unit tests for the stoker commands module
+import unittest
+import io
+from stoker.commands import _pretty_print_size
+from stoker.commands import _BufferedPrinter
+
+#
+# Tests
+class TestPrettyPrintSize(unittest.TestCase):
+    def test_pretty_print_size_bytes(self):
+        self.assertEqual(_pretty_print_size(0),"0.0b")
+        self.assertEqual(_pretty_print_size(1),"1.0b")
+        self.assertEqual(_pretty_print_size(1023),"1023.0b")
+        self.assertEqual(_pretty_print_size(1024),"1024.0b")
+
+    def test_pretty_print_size_kilobytes(self):
+        self.assertEqual(_pretty_print_size(1025),"1.0K")
+        self.assertEqual(_pretty_print_size(1536),"1.5K")
+        self.assertEqual(_pretty_print_size(1024*1024),"1024.0K")
+
+    def test_pretty_print_size_megabytes(self):
+        self.assertEqual(_pretty_print_size(1024*1024+1),"1.0M")
+        self.assertEqual(_pretty_print_size(5*1024*1024),"5.0M")
+
+    def test_pretty_print_size_gigabytes(self):
+        self.assertEqual(_pretty_print_size(1024*1024*1024+1),"1.0G")
+        self.assertEqual(_pretty_print_size(1 << 40),"1024.0G")
+        self.assertEqual(_pretty_print_size(1 << 50),"1048576.0G")
+
+class TestBufferedPrinter(unittest.TestCase):
+    def test_buffered_printer(self):
+        fp = io.StringIO()
+        with _BufferedPrinter(fp=fp) as out:
+            out.print("line 1")
+            out.print("line 2")
+            self.assertEqual(fp.getvalue(),"")
+        self.assertEqual(fp.getvalue(),"line 1\nline 2\n")
+
+    def test_buffered_printer_flushes_when_full(self):
+        fp = io.StringIO()
+        with _BufferedPrinter(fp=fp,bufsize=10) as out:
+            out.print("line 1")
+            self.assertEqual(fp.getvalue(),"")
+            out.print("line 2")
+            self.assertEqual(fp.getvalue(),"line 1\nline 2\n")
+            out.print("line 3")
+        self.assertEqual(fp.getvalue(),"line 1\nline 2\nline 3\n")
+
+    def test_buffered_printer_no_output(self):
+        fp = io.StringIO()
+        with _BufferedPrinter(fp=fp) as out:
+            pass
+        self.assertEqual(fp.getvalue(),"")
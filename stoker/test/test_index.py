@@ -3,6 +3,7 @@
 # Unit tests for the stoker index module
 import unittest
 import os
+import sys
 import tempfile
 import shutil
 import time
@@ -10,6 +11,10 @@ import getpass
 import grp
 import gzip
 import bz2
+import io
+import contextlib
+from unittest import mock
+import stoker.index
 from stoker.index import FilesystemObjectType
 from stoker.index import FilesystemObjectStat
 from stoker.index import FilesystemObject
@@ -20,16 +25,28 @@ from stoker.index import find
 
 #
 # Helper functions
+def _chmod_and_retry(func,path,excinfo):
+    # Error handler for shutil.rmtree: make the failing
+    # path (and its parent) accessible and try again
+    if not os.path.lexists(path):
+        return
+    os.chmod(os.path.dirname(path),0o755)
+    if os.path.isdir(path) and not os.path.islink(path):
+        os.chmod(path,0o755)
+        if func is not os.rmdir:
+            # Couldn't read the directory so remove it and
+            # its contents separately
+            _remove_dir(path)
+            return
+    func(path)
+
 def _remove_dir(dirn):
-    for root,dirs,files in os.walk(dirn):
-        for name in dirs:
-            os.chmod(os.path.join(root,name),0o755)
-        for name in files:
-            try:
-                os.chmod(os.path.join(root,name),0o644)
-            except OSError:
-                pass
-    shutil.rmtree(dirn)
+    # 'onerror' is deprecated from Python 3.12 (replaced by
+    # 'onexc', which isn't available in earlier versions)
+    if sys.version_info >= (3,12):
+        shutil.rmtree(dirn,onexc=_chmod_and_retry)
+    else:
+        shutil.rmtree(dirn,onerror=_chmod_and_retry)
 #
 # Tests
 class TestFileSystemObjectStat(unittest.TestCase):
@@ -96,6 +113,36 @@ class TestFileSystemObjectStat(unittest.TestCase):
         self.assertEqual(FilesystemObjectStat("missing.txt").get("mode"),
                          None)
 
+    @unittest.skipIf(stoker.index._USE_STATX,
+                     "statx only fetches the basic attributes")
+    def test_get_other_attributes(self):
+        # Make file
+        with open("test.txt","w") as fp:
+            fp.write("test")
+        st = os.lstat("test.txt")
+        self.assertEqual(FilesystemObjectStat("test.txt").get("ino"),
+                         st.st_ino)
+        self.assertEqual(FilesystemObjectStat("test.txt").get("nlink"),
+                         st.st_nlink)
+        self.assertEqual(FilesystemObjectStat("test.txt").get("ctime"),
+                         st.st_ctime)
+        self.assertRaises(AttributeError,
+                          FilesystemObjectStat("test.txt").get,
+                          "missing")
+
+    def test_no_instance_dict(self):
+        self.assertFalse(hasattr(FilesystemObjectStat("missing.txt"),
+                                 "__dict__"))
+
+    def test_get_attributes_not_held_in_index(self):
+        # Make file
+        with open("test.txt","w") as fp:
+            fp.write("test")
+        st = FilesystemObjectIndex(".")["test.txt"].stat
+        self.assertEqual(st.get("size"),4)
+        self.assertEqual(st.get("ino"),None)
+        self.assertEqual(st.get("atime"),None)
+
 class TestFilesystemObject(unittest.TestCase):
     def setUp(self):
         # Create a temp working dir
@@ -342,6 +389,17 @@ class TestFilesystemObject(unittest.TestCase):
         self.assertEqual(FilesystemObject("test.txt").md5sum,
                          "098f6bcd4621d373cade4e832627b4f6")
 
+    def test_checksum(self):
+        # Make test filesystem objects
+        with open("test.txt","wt") as fp:
+            fp.write("test")
+        self.assertEqual(FilesystemObject("test.txt").checksum(),
+                         "098f6bcd4621d373cade4e832627b4f6")
+        self.assertEqual(FilesystemObject("test.txt").checksum("sha1"),
+                         "a94a8fe5ccb19ba61c4c0873d391e987982fbbd3")
+        self.assertEqual(FilesystemObject("missing").checksum("sha1"),
+                         None)
+
     def test_linux_permissions(self):
         # Make test filesystem object
         with open("test.txt","wt") as fp:
@@ -465,11 +523,12 @@ class TestFilesystemObjectIndex(unittest.TestCase):
         # Check __contains__
         for d in dirs:
             self.assertTrue(d in indx)
-        for d in files:
+        for f in files:
             self.assertTrue(f in indx)
         for s in symlinks:
             self.assertTrue(s in indx)
         self.assertFalse("missing" in indx)
+        self.assertNotIn("does/not/exist",indx)
         # Check names
         for n in indx.names:
             self.assertTrue((n in dirs) or
@@ -486,6 +545,228 @@ class TestFilesystemObjectIndex(unittest.TestCase):
         # but seems to work for testing
         self.assertRaises(KeyError,indx.__getitem__,"missing")
 
+    def test_objectindex_info(self):
+        # Add some objects to current dir
+        os.mkdir("test.dir")
+        with open("test.txt","wt") as fp:
+            fp.write("test\n")
+        os.symlink("test.txt","test.lnk")
+        # Build the index
+        indx = FilesystemObjectIndex(self.wd)
+        username = getpass.getuser()
+        info = indx.info("test.txt")
+        self.assertFalse(info.islink)
+        self.assertEqual(info.size,5)
+        self.assertEqual(info.username,username)
+        self.assertEqual(info.symlink_target,None)
+        info = indx.info("test.lnk")
+        self.assertTrue(info.islink)
+        self.assertEqual(info.username,username)
+        self.assertEqual(info.symlink_target,"test.txt")
+        info = indx.info("test.dir")
+        self.assertFalse(info.islink)
+        self.assertEqual(info.symlink_target,None)
+        self.assertRaises(KeyError,indx.info,"missing")
+
+    def test_objectindex_checksum(self):
+        # Add a file to current dir
+        with open("test.txt","wt") as fp:
+            fp.write("test")
+        # Build the index
+        indx = FilesystemObjectIndex(self.wd)
+        self.assertEqual(indx.checksum("test.txt"),
+                         "098f6bcd4621d373cade4e832627b4f6")
+        self.assertEqual(indx.checksum("test.txt","sha1"),
+                         "a94a8fe5ccb19ba61c4c0873d391e987982fbbd3")
+        # Checksum reflects changes to the file contents
+        with open("test.txt","wt") as fp:
+            fp.write("TEST")
+        self.assertEqual(indx.checksum("test.txt"),
+                         "033bd94b1168d7e4f0d644c3c95e35bf")
+        self.assertRaises(KeyError,indx.checksum,"missing")
+
+    def test_objectindex_subtree(self):
+        # Add some objects to current dir
+        for d in ("test.dir",
+                  "test.dir/sub.dir",
+                  "test.dir2",):
+            os.mkdir(d)
+        for f in ("test.dir.txt",
+                  "test.dir/test.txt",
+                  "test.dir/sub.dir/test.txt",
+                  "test.dir2/test.txt",):
+            with open(f,"wt") as fp:
+                fp.write("test\n")
+        # Build the index
+        indx = FilesystemObjectIndex(self.wd)
+        self.assertEqual(indx.subtree("test.dir"),
+                         ["test.dir/sub.dir",
+                          "test.dir/sub.dir/test.txt",
+                          "test.dir/test.txt",])
+        self.assertEqual(indx.subtree("test.dir/sub.dir/"),
+                         ["test.dir/sub.dir/test.txt",])
+        self.assertEqual(indx.subtree("test.dir2"),
+                         ["test.dir2/test.txt",])
+        self.assertEqual(indx.subtree("test.dir.txt"),[])
+        self.assertEqual(indx.subtree("missing"),[])
+        self.assertEqual(indx.subtree(""),sorted(indx.names))
+
+    def test_objectindex_serial_and_parallel_scans(self):
+        # Add enough objects to trigger the parallel scan
+        for i in range(10):
+            d = "test%d.dir" % i
+            os.mkdir(d)
+            os.mkdir(os.path.join(d,"sub.dir"))
+            with open(os.path.join(d,"sub.dir","test.txt"),"wt") as fp:
+                fp.write("test\n")
+        # Build the indexes
+        serial_indx = FilesystemObjectIndex(self.wd,workers=1)
+        parallel_indx = FilesystemObjectIndex(self.wd,workers=4)
+        self.assertEqual(len(serial_indx),30)
+        self.assertEqual(serial_indx.names,sorted(serial_indx.names))
+        self.assertEqual(parallel_indx.names,serial_indx.names)
+
+    def test_objectindex_invalid_walk_threads(self):
+        # Add some objects to current dir
+        for i in range(10):
+            os.mkdir("test%d.dir" % i)
+        # Build the index with an invalid number of threads
+        walk_threads = os.environ.get("STOKER_WALK_THREADS")
+        os.environ["STOKER_WALK_THREADS"] = "yes"
+        try:
+            with contextlib.redirect_stderr(io.StringIO()):
+                indx = FilesystemObjectIndex(self.wd)
+        finally:
+            if walk_threads is None:
+                del(os.environ["STOKER_WALK_THREADS"])
+            else:
+                os.environ["STOKER_WALK_THREADS"] = walk_threads
+        self.assertEqual(len(indx),10)
+
+    def test_objectindex_sorted_by_inode(self):
+        # Add some objects to current dir
+        for i in range(10):
+            d = "test%d.dir" % i
+            os.mkdir(d)
+            with open(os.path.join(d,"test.txt"),"wt") as fp:
+                fp.write("test\n")
+        # Build the indexes
+        sort_by_inode = os.environ.get("STOKER_SORT_BY_INODE")
+        os.environ["STOKER_SORT_BY_INODE"] = "1"
+        try:
+            serial_indx = FilesystemObjectIndex(self.wd,workers=1)
+            parallel_indx = FilesystemObjectIndex(self.wd,workers=4)
+        finally:
+            if sort_by_inode is None:
+                del(os.environ["STOKER_SORT_BY_INODE"])
+            else:
+                os.environ["STOKER_SORT_BY_INODE"] = sort_by_inode
+        self.assertEqual(len(serial_indx),20)
+        self.assertEqual(sorted(serial_indx.names),
+                         sorted(FilesystemObjectIndex(self.wd).names))
+        self.assertEqual(sorted(parallel_indx.names),
+                         sorted(serial_indx.names))
+
+    def test_objectindex_invalid_sort_by_inode(self):
+        # Add some objects to current dir
+        for i in range(10):
+            os.mkdir("test%d.dir" % i)
+        # Build the index with an invalid setting
+        sort_by_inode = os.environ.get("STOKER_SORT_BY_INODE")
+        os.environ["STOKER_SORT_BY_INODE"] = ""
+        try:
+            with contextlib.redirect_stderr(io.StringIO()):
+                indx = FilesystemObjectIndex(self.wd)
+        finally:
+            if sort_by_inode is None:
+                del(os.environ["STOKER_SORT_BY_INODE"])
+            else:
+                os.environ["STOKER_SORT_BY_INODE"] = sort_by_inode
+        self.assertEqual(len(indx),10)
+
+    def test_objectindex_with_snapshot(self):
+        # Use a temporary cache directory for snapshots
+        cache_dir = tempfile.mkdtemp(suffix=self.__class__.__name__)
+        xdg_cache_home = os.environ.get("XDG_CACHE_HOME")
+        os.environ["XDG_CACHE_HOME"] = cache_dir
+        try:
+            # Add some objects to current dir
+            os.mkdir("test1.dir")
+            os.mkdir("test1.dir/sub.dir")
+            os.mkdir("test2.dir")
+            for f in ("test.txt",
+                      "test1.dir/test.txt",
+                      "test1.dir/sub.dir/test.txt",
+                      "test2.dir/test.txt"):
+                with open(f,"wt") as fp:
+                    fp.write("test\n")
+            # Make the directories look older than the snapshot
+            past = time.time() - 60
+            for d in (".","test1.dir","test1.dir/sub.dir","test2.dir"):
+                os.utime(d,(past,past))
+            # Build the index and save a snapshot
+            indx = FilesystemObjectIndex(self.wd,use_snapshot=True)
+            self.assertTrue(os.path.exists(indx.snapshot_file))
+            self.assertEqual(sorted(indx.names),
+                             sorted(FilesystemObjectIndex(self.wd).names))
+            # Add a new file (and make sure the directory's
+            # mtime moves)
+            with open("test1.dir/sub.dir/new.txt","wt") as fp:
+                fp.write("new\n")
+            future = time.time() + 60
+            os.utime("test1.dir/sub.dir",(future,future))
+            # Change the size of a file in an unmodified directory
+            # (restoring the directory's mtime)
+            with open("test2.dir/test.txt","wt") as fp:
+                fp.write("changed\n")
+            os.utime("test2.dir",(past,past))
+            # Rebuild using the snapshot
+            indx = FilesystemObjectIndex(self.wd,use_snapshot=True)
+            self.assertEqual(len(indx),8)
+            self.assertTrue("test1.dir/sub.dir/new.txt" in indx)
+            self.assertEqual(indx["test1.dir/sub.dir/new.txt"].size,4)
+            self.assertEqual(sorted(indx.names),
+                             sorted(FilesystemObjectIndex(self.wd).names))
+            # Unmodified directory is taken from the snapshot
+            self.assertEqual(indx["test2.dir/test.txt"].size,5)
+            self.assertEqual(
+                FilesystemObjectIndex(self.wd)["test2.dir/test.txt"].size,8)
+        finally:
+            if xdg_cache_home is None:
+                del(os.environ["XDG_CACHE_HOME"])
+            else:
+                os.environ["XDG_CACHE_HOME"] = xdg_cache_home
+            shutil.rmtree(cache_dir)
+
+    def test_objectindex_snapshot_recently_modified_directory(self):
+        # Use a temporary cache directory for snapshots
+        cache_dir = tempfile.mkdtemp(suffix=self.__class__.__name__)
+        xdg_cache_home = os.environ.get("XDG_CACHE_HOME")
+        os.environ["XDG_CACHE_HOME"] = cache_dir
+        try:
+            # Add some objects to current dir
+            os.mkdir("test.dir")
+            with open("test.dir/test.txt","wt") as fp:
+                fp.write("test\n")
+            # Build the index and save a snapshot
+            FilesystemObjectIndex(self.wd,use_snapshot=True)
+            # Add a new file without changing the directory's
+            # mtime (as if it happened in the same tick as the
+            # scan)
+            st = os.stat("test.dir")
+            with open("test.dir/new.txt","wt") as fp:
+                fp.write("new\n")
+            os.utime("test.dir",ns=(st.st_atime_ns,st.st_mtime_ns))
+            # Directory is scanned again when rebuilding
+            indx = FilesystemObjectIndex(self.wd,use_snapshot=True)
+            self.assertTrue("test.dir/new.txt" in indx)
+        finally:
+            if xdg_cache_home is None:
+                del(os.environ["XDG_CACHE_HOME"])
+            else:
+                os.environ["XDG_CACHE_HOME"] = xdg_cache_home
+            shutil.rmtree(cache_dir)
+
 class TestCompareFunction(unittest.TestCase):
     def setUp(self):
         # Create a temp working dir
@@ -520,10 +801,11 @@ class TestCompareFunction(unittest.TestCase):
         return (dirs,files,symlinks)
 
     def _copy_dir(self,src,tgt):
-        # Copy directory tree and attributes
-        # Would prefer to use shutil.copytree but this doesn't
-        # seem to preserve timestamps?
-        os.system("cp -aR %s %s" % (src,tgt))
+        # Copy directory tree and attributes (copy2 preserves
+        # timestamps on files, and copytree also copies them for
+        # directories and symlinks)
+        shutil.copytree(src,tgt,symlinks=True,
+                        copy_function=shutil.copy2)
 
     def test_compare_empty(self):
         os.mkdir("test1")
@@ -558,6 +840,120 @@ class TestCompareFunction(unittest.TestCase):
         self.assertEqual(diff.changed_link,[])
         self.assertEqual(diff.changed_time,[])
 
+    def test_compare_with_identical_metadata(self):
+        # Make reference directory
+        os.mkdir("test1")
+        self._populate_dir("test1")
+        # Make directory to compare
+        self._copy_dir("test1","test2")
+        # Change content without changing size or timestamp
+        st = os.lstat("test2/test1.dir/test.txt")
+        with open("test2/test1.dir/test.txt","wt") as fp:
+            fp.write("BLAH\n")
+        os.utime("test2/test1.dir/test.txt",
+                 ns=(st.st_atime_ns,st.st_mtime_ns))
+        # Build indexes
+        indx1 = FilesystemObjectIndex("test1")
+        indx2 = FilesystemObjectIndex("test2")
+        # Do comparison
+        diff = compare(indx1,indx2)
+        self.assertEqual(diff.missing,[])
+        self.assertEqual(diff.extra,[])
+        self.assertEqual(diff.restricted_source,[])
+        self.assertEqual(diff.restricted_target,[])
+        self.assertEqual(diff.changed_type,[])
+        self.assertEqual(diff.changed_size,[])
+        self.assertEqual(diff.changed_md5,["test1.dir/test.txt"])
+        self.assertEqual(diff.changed_link,[])
+        self.assertEqual(diff.changed_time,[])
+
+    def test_compare_serial_and_parallel_md5_checks(self):
+        # Make reference directory
+        os.mkdir("test1")
+        self._populate_dir("test1")
+        # Make directory to compare
+        self._copy_dir("test1","test2")
+        # Change content of some files (one with a change of
+        # size)
+        for f in ("test.txt","test1.dir/test.txt"):
+            with open(os.path.join("test2",f),"wt") as fp:
+                fp.write("BLAH\n")
+        with open("test2/test2.dir/test.txt","wt") as fp:
+            fp.write("blah blah\n")
+        # Build indexes
+        indx1 = FilesystemObjectIndex("test1")
+        indx2 = FilesystemObjectIndex("test2")
+        # Do comparisons
+        for workers in (1,4):
+            diff = compare(indx1,indx2,workers=workers)
+            self.assertEqual(diff.changed_size,["test2.dir/test.txt"])
+            self.assertEqual(diff.changed_md5,["test.txt",
+                                               "test1.dir/test.txt",
+                                               "test2.dir/test.txt"])
+
+    def test_compare_parallel_md5_checks_many_files(self):
+        # Make directories with more files than the number
+        # of checks submitted at once
+        for d in ("test1","test2"):
+            os.mkdir(d)
+            for i in range(20):
+                with open(os.path.join(d,"test%02d.txt" % i),"wt") as fp:
+                    fp.write("test\n")
+        # Change content of some files
+        for i in (3,11,19):
+            with open(os.path.join("test2","test%02d.txt" % i),"wt") as fp:
+                fp.write("TEST\n")
+        # Build indexes
+        indx1 = FilesystemObjectIndex("test1")
+        indx2 = FilesystemObjectIndex("test2")
+        diff = compare(indx1,indx2,workers=2)
+        self.assertEqual(diff.changed_md5,["test03.txt",
+                                           "test11.txt",
+                                           "test19.txt"])
+
+    def test_compare_with_hard_links(self):
+        # Make reference directory
+        os.mkdir("test1")
+        for f in ("test1.txt","test2.txt","test3.txt"):
+            with open(os.path.join("test1",f),"wt") as fp:
+                fp.write("test\n")
+        # Make directory of hard links to the reference files
+        # (except for one which is replaced by a new file)
+        os.mkdir("test2")
+        for f in ("test1.txt","test2.txt","test3.txt"):
+            os.link(os.path.join("test1",f),os.path.join("test2",f))
+        os.remove("test2/test3.txt")
+        with open("test2/test3.txt","wt") as fp:
+            fp.write("TEST\n")
+        # Build indexes
+        indx1 = FilesystemObjectIndex("test1")
+        indx2 = FilesystemObjectIndex("test2")
+        # Hard linked files should only be read once
+        with mock.patch.object(FilesystemObject,"checksum",
+                               autospec=True,
+                               side_effect=FilesystemObject.checksum) \
+                               as checksum:
+            diff = compare(indx1,indx2,workers=1)
+        self.assertEqual(diff.changed_md5,["test3.txt"])
+        self.assertEqual(checksum.call_count,4)
+
+    def test_compare_with_other_hash_algorithm(self):
+        # Make reference directory
+        os.mkdir("test1")
+        self._populate_dir("test1")
+        # Make directory to compare
+        self._copy_dir("test1","test2")
+        # Change content without changing size
+        with open("test2/test1.dir/test.txt","wt") as fp:
+            fp.write("BLAH\n")
+        # Build indexes
+        indx1 = FilesystemObjectIndex("test1")
+        indx2 = FilesystemObjectIndex("test2")
+        # Do comparison
+        diff = compare(indx1,indx2,hash_algo="sha1")
+        self.assertEqual(diff.changed_size,[])
+        self.assertEqual(diff.changed_md5,["test1.dir/test.txt"])
+
     def test_compare_with_differences(self):
         # Make reference directory
         os.mkdir("test1")
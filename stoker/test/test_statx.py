@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+#
+# Unit tests for the stoker _statx module
+import unittest
+import os
+import tempfile
+import shutil
+from stoker._statx import lstat
+
+#
+# Tests
+class TestLstat(unittest.TestCase):
+    def setUp(self):
+        # Create a temp working dir
+        self.wd = tempfile.mkdtemp(suffix=self.__class__.__name__)
+        self.pwd = os.getcwd()
+        os.chdir(self.wd)
+
+    def tearDown(self):
+        os.chdir(self.pwd)
+        shutil.rmtree(self.wd)
+
+    def _assert_matches_os_lstat(self,path):
+        st = lstat(path)
+        os_st = os.lstat(path)
+        self.assertEqual(st.st_mode,os_st.st_mode)
+        self.assertEqual(st.st_uid,os_st.st_uid)
+        self.assertEqual(st.st_gid,os_st.st_gid)
+        self.assertEqual(st.st_size,os_st.st_size)
+        self.assertEqual(st.st_mtime,os_st.st_mtime)
+        self.assertEqual(st.st_mtime_ns,os_st.st_mtime_ns)
+
+    def test_lstat_file(self):
+        with open("test.txt","wt") as fp:
+            fp.write("test")
+        self._assert_matches_os_lstat("test.txt")
+
+    def test_lstat_directory(self):
+        os.mkdir("test.dir")
+        self._assert_matches_os_lstat("test.dir")
+
+    def test_lstat_symlink(self):
+        os.symlink("missing","missing.lnk")
+        self._assert_matches_os_lstat("missing.lnk")
+
+    def test_lstat_missing(self):
+        self.assertRaises(FileNotFoundError,lstat,"missing")